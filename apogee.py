@@ -1,13 +1,14 @@
 # Original https://www.apogeeinstruments.com/apogee-usb-sensors-and-linux/
 # chatGPT updated to python3, adding get logged data and CLI
 
-from time import sleep
-
+import numpy as np
 import pandas as pd
 
+import os
 import struct
 import argparse
-import csv
+import queue
+import threading
 from datetime import datetime, timedelta
 from serial import Serial, SerialException
 
@@ -26,21 +27,91 @@ GET_LOGGED_ENTRY = b'\xf2%s!'
 
 ERASE_LOGGED_DATA = b'\xf4!'
 
+# precompiled little endian float / unsigned int reply payloads
+_F32 = struct.Struct('<f')
+_U32 = struct.Struct('<I')
+
+# one W/m2 reading held for a minute, in kWh/m2
+_KWH_PER_WATT_MINUTE = np.float32(0.001 / 60.0)
+
+# number of GET_LOGGED_ENTRY requests kept in flight at once
+LOGGED_ENTRY_BATCH = 32
+
+# command byte, 4 byte index and '!'
+LOGGED_ENTRY_REQUEST_SIZE = 6
+
+# a logged entry reply, one leading byte then the value
+LOGGED_ENTRY_DTYPE = np.dtype([('command', 'u1'), ('entry', '<f4')])
+
+# report download progress every this many entries
+PROGRESS_INTERVAL = 256
+
+# write buffer for the logged entries CSV
+CSV_BUFFER_SIZE = 1 << 20
+
+# line ending of the logged entries CSV
+CSV_LINE_TERMINATOR = '\r\n'
+
+# batches of logged entries allowed to wait for the writer thread
+CSV_QUEUE_SIZE = 1024
+
+# seconds between checks that the writer thread is still alive
+CSV_QUEUE_TIMEOUT = 1.0
+
+# FTDI driver attributes, see ftdi_sio on Linux
+FTDI_SYSFS_DIR = '/sys/bus/usb-serial/devices/%s'
+
+# flush the FTDI receive buffer after 1ms instead of the default 16ms
+FTDI_LATENCY_TIMER = '1'
+
+# also flush as soon as '!' arrives (bit 8 enables the event character)
+FTDI_EVENT_CHAR = str(ord('!') | 0x100)
+
+
+def write_entries_worker(entries_queue, csvfile, errors):
+    """Write batches of logged entries from entries_queue to csvfile
+
+    Each batch is a (first timestamp, minute offsets, entries) triple.
+    Runs until None is taken from the queue, or stops after appending
+    the exception to errors if writing fails."""
 
-def try_convert_date(val):
     try:
-        return pd.to_datetime(val)
-    except ValueError:
-        return pd.NaT  # Return 'not a time' for invalid dates
+        while True:
+            batch = entries_queue.get()
+            if batch is None:
+                break
+            first_timestamp, offsets, entries = batch
+            timestamps = first_timestamp + pd.to_timedelta(offsets, unit='min')
+            pd.DataFrame({'timestamp': timestamps, 'entry': entries}).to_csv(
+                csvfile, header=False, index=False,
+                lineterminator=CSV_LINE_TERMINATOR)
+    except Exception as error:
+        errors.append(error)
+
+
+def put_entries(entries_queue, batch, csv_thread):
+    """Queue batch for csv_thread, returns False if the thread has died"""
+
+    while csv_thread.is_alive():
+        try:
+            entries_queue.put(batch, timeout=CSV_QUEUE_TIMEOUT)
+            return True
+        except queue.Full:
+            pass
+    return False
 
 
 class Quantum(object):
 
-    def __init__(self, port):
+    def __init__(self, port, low_latency=True):
         self.quantum = None
         self.offset = 0.0
         self.multiplier = 0.0
         self.port = port
+        self.low_latency = low_latency
+        # reused receive buffer for batched replies
+        self._rxbuf = bytearray(5 * LOGGED_ENTRY_BATCH)
+        self._rxmv = memoryview(self._rxbuf)
         self.connect_to_device()
 
     def connect_to_device(self):
@@ -48,22 +119,78 @@ class Quantum(object):
 
         and attempts to read the calibration values"""
 
+        if self._open_port():
+
+            self._read_calibration()
+
+    def _open_port(self):
+        """Open the serial port, returns False if the device is missing"""
+
         try:
-            self.quantum = Serial(self.port, 115200, timeout=0.5)
+            # replies are raw binary floats, so software or hardware flow
+            # control must never eat or wait on any of their bytes
+            self.quantum = Serial(self.port, 115200, timeout=0.5,
+                                  xonxoff=False, rtscts=False)
+
+            if self.low_latency:
 
+                self.set_low_latency()
+
+        except SerialException:
+            print("Can't locate device")
+            self.quantum = None
+            return False
+
+        return True
+
+    def _read_calibration(self):
+        """Read the multiplier and offset stored on the device
+
+        On failure the port stays open and the multiplier stays 0.0, so
+        read_voltage tries again later."""
+
+        try:
             self.quantum.write(READ_CALIBRATION)
 
             multiplier = self.quantum.read(5)[1:]
 
             offset = self.quantum.read(4)
 
-            self.multiplier = struct.unpack('<f', multiplier)[0]
+            self.multiplier = _F32.unpack(multiplier)[0]
 
-            self.offset = struct.unpack('<f', offset)[0]
+            self.offset = _F32.unpack(offset)[0]
 
-        except SerialException:
-            print("Can't locate device")
-            self.quantum = None
+        except SerialException as data:
+            print(data)
+
+        except struct.error:
+            print("Can't read calibration")
+            # drop a partial reply so the next command isn't misaligned
+            self.quantum.reset_input_buffer()
+
+    def set_low_latency(self):
+        """Lower the FTDI latency timer so short replies aren't held back
+
+        and put the tty in ASYNC_LOW_LATENCY mode. This is best effort, it
+        needs write access to sysfs and is skipped on other platforms and
+        adapters."""
+
+        try:
+            self.quantum.set_low_latency_mode(True)
+        except (AttributeError, ValueError):
+            # not on Linux, or the driver rejected TIOCSSERIAL
+            pass
+
+        tty = os.path.basename(os.path.realpath(self.port))
+        sysfs_dir = FTDI_SYSFS_DIR % tty
+
+        for name, value in (('latency_timer', FTDI_LATENCY_TIMER),
+                            ('event_char', FTDI_EVENT_CHAR)):
+            try:
+                with open(os.path.join(sysfs_dir, name), 'w') as attr:
+                    attr.write(value)
+            except OSError:
+                pass
 
     def get_micromoles(self):
         """This function converts the voltage to micromoles"""
@@ -87,74 +214,75 @@ class Quantum(object):
         return micromoles
 
     def read_voltage(self):
-        """This function averages 5 readings over 1 second and returns
+        """This function averages 5 readings and returns the result.
 
-        the result."""
+        All requests are sent at once and the replies read back together."""
 
         if self.quantum is None:
 
-            try:
-
-                self.connect_to_device()
+            # only reopen the port, a calibration read earlier is kept
 
-            except IOError:
+            if not self._open_port():
 
                 # you can raise some sort of exception here if you need to
 
-                return
+                return 9999
 
-        # store the responses to average
+        if not self.multiplier:
 
-        response_list = []
+            # the calibration never arrived, ask for it again
 
-        # change to average more or less samples over the given time period
+            self._read_calibration()
 
-        number_to_average = 5
+        # running total and count of the responses to average
 
-        # change to shorten or extend the time duration for each measurement
+        total = 0.0
 
-        # be sure to leave as floating point to avoid truncation
+        received = 0
 
-        number_of_seconds = 1.0
+        # change to average more or less samples per measurement
 
-        for i in range(number_to_average):
+        # (at most LOGGED_ENTRY_BATCH replies fit in the receive buffer)
 
-            try:
+        number_to_average = 5
+
+        try:
 
-                self.quantum.write(GET_VOLT)
+            self.quantum.write(GET_VOLT * number_to_average)
 
-                response = self.quantum.read(5)[1:]
+            received_bytes = self.read_replies(number_to_average)
 
-            except IOError as data:
+        except IOError as data:
 
-                print(data)
+            print(data)
 
-                # dummy value to know something went wrong. could raise an
+            # drop the port so the next call reopens it
 
-                # exception here alternatively
+            self.quantum.close()
 
-                return 9999
+            self.quantum = None
 
-            else:
+            # dummy value to know something went wrong. could raise an
+
+            # exception here alternatively
 
-                if not response:
+            return 9999
 
-                    continue
+        # a timed out request leaves a short read, only whole replies count
 
-                # if the response is not 4 bytes long, this line will raise
+        if received_bytes < 5 * number_to_average:
 
-                # an exception
+            # drop late replies so the next command doesn't read them
 
-                voltage = struct.unpack('<f', response)[0]
-                response_list.append(voltage)
+            self.quantum.reset_input_buffer()
 
-                sleep(number_of_seconds / number_to_average)
+        for offset in range(0, received_bytes - 4, 5):
 
-        if response_list:
+            total += _F32.unpack_from(self._rxmv, offset + 1)[0]
 
-            return sum(response_list) / len(response_list)
+            received += 1
 
-        return 0.0
+        return total / received if received else 0.0
 
     def erase_logged_data(self):
         try:
@@ -169,7 +297,7 @@ class Quantum(object):
             self.quantum.write(GET_LOGGING_COUNT)
             response = self.quantum.read(5)[1:]
             if response:
-                count = struct.unpack('<I', response)[0]
+                count = _U32.unpack(response)[0]
                 return count
             else:
                 return 0
@@ -177,64 +305,166 @@ class Quantum(object):
             print(data)
             return None
 
+    def read_replies(self, n):
+        """Read n 5 byte replies into the receive buffer
+
+        Returns the number of bytes received, which is short if the read
+        timed out."""
+
+        return self.quantum.readinto(self._rxmv[:5 * n])
+
+    def read_logged_batch(self, cmds, base, n):
+        """Request logged entries base to base + n and return their values
+
+        cmds holds the prebuilt GET_LOGGED_ENTRY requests for every index
+        back to back. Returns the offsets from base of the entries that
+        answered together with their values."""
+
+        size = LOGGED_ENTRY_REQUEST_SIZE
+        self.quantum.write(cmds[size * base:size * (base + n)])
+        if self.read_replies(n) == 5 * n:
+            # view the replies as packed records and copy out their floats,
+            # the receive buffer is reused by the next batch. Widening to
+            # float64 keeps the CSV values written as full double reprs
+            replies = np.frombuffer(self._rxbuf, dtype=LOGGED_ENTRY_DTYPE,
+                                    count=n)
+            return np.arange(n), replies['entry'].astype(np.float64)
+
+        # a skipped request can't be told apart from its neighbours, so
+        # drop what arrived and ask for each entry of this batch on its own
+        self.quantum.reset_input_buffer()
+        offsets = []
+        entries = []
+        for j in range(n):
+            i = base + j
+            self.quantum.write(cmds[size * i:size * (i + 1)])
+            if self.read_replies(1) == 5:
+                offsets.append(j)
+                entries.append(_F32.unpack_from(self._rxmv, 1)[0])
+            else:
+                self.quantum.reset_input_buffer()
+        return offsets, entries
+
     def get_all_logged_entries(self, current_datetime):
         count = self.get_logging_count()
         if count is not None:
-            with open('logged_entries.csv', 'w', newline='') as csvfile:
-                writer = csv.writer(csvfile)
-                writer.writerow(['timestamp', 'entry'])
+            with open('logged_entries.csv', 'w', newline='',
+                      buffering=CSV_BUFFER_SIZE) as csvfile:
+                # same line ending the csv module used
+                csvfile.write('timestamp,entry' + CSV_LINE_TERMINATOR)
 
                 # Calculate earliest timestamp
                 earliest_datetime = current_datetime - timedelta(minutes=count)
 
+                # build every request up front in one contiguous buffer so
+                # each batch goes out in a single write instead of one round
+                # trip per entry
+                size = LOGGED_ENTRY_REQUEST_SIZE
+                cmds = bytearray(size * count)
+                cmds[0::size] = GET_LOGGED_ENTRY[:1] * count
+                cmds[size - 1::size] = GET_LOGGED_ENTRY[-1:] * count
                 for i in range(count):
-                    try:
-                        # Convert the index to bytes and pad it to 4 bytes
-                        index_bytes = struct.pack('<I', i)
-                        self.quantum.write(GET_LOGGED_ENTRY % index_bytes)
-                        response = self.quantum.read(5)[1:]
-                        if response:
-                            entry = struct.unpack('<f', response)[0]
+                    _U32.pack_into(cmds, size * i + 1, i)
+                cmds = memoryview(cmds)
+
+                # format and write the CSV on a separate thread so disk
+                # writes overlap with waiting on the serial port
+                entries_queue = queue.Queue(maxsize=CSV_QUEUE_SIZE)
+                csv_errors = []
+                csv_thread = threading.Thread(
+                    target=write_entries_worker,
+                    args=(entries_queue, csvfile, csv_errors), daemon=True)
+                csv_thread.start()
+
+                try:
+                    for base in range(0, count, LOGGED_ENTRY_BATCH):
+                        n = min(LOGGED_ENTRY_BATCH, count - base)
+                        try:
+                            offsets, entries = self.read_logged_batch(
+                                cmds, base, n)
+                        except IOError as data:
+                            print(data)
+                            continue
+
+                        if len(entries):
                             timestamp = earliest_datetime + \
-                                timedelta(minutes=i)
-                            writer.writerow([timestamp, entry])
-                        # Output progress information
-                        print(f'Progress: {i+1}/{count} entries read.')
-                    except IOError as data:
-                        print(data)
+                                timedelta(minutes=base)
+                            batch = (timestamp, offsets, entries)
+                            # stop if the writer died, its error is raised
+                            # below
+                            if not put_entries(entries_queue, batch,
+                                               csv_thread):
+                                break
 
-    def calculate_kwh(self, csv_file, min_val, max_val):
-        # specify column names in names parameter
-        data = pd.read_csv(csv_file, names=['timestamp', 'entry'])
-
-        # convert 'timestamp' column to datetime and handle errors
-        data['timestamp'] = data['timestamp'].apply(try_convert_date)
-
-        # remove rows with invalid dates
-        data = data.dropna(subset=['timestamp'])
-
-        # Convert 'entry' to numeric, force non-numeric values to NaN
-        data['entry'] = pd.to_numeric(data['entry'], errors='coerce')
+                        # Output progress information
+                        done = base + n
+                        if done % PROGRESS_INTERVAL == 0 or done == count:
+                            print(f'Progress: {done}/{count} entries read.')
+                finally:
+                    # let the writer drain the queue before the file closes
+                    put_entries(entries_queue, None, csv_thread)
+                    csv_thread.join()
 
-        # filter data
-        data = data[(data['entry'] >= min_val) & (data['entry'] <= max_val)]
+                if csv_errors:
+                    raise csv_errors[0]
 
-        # calculate sum of 'entry' for each day
-        daily_sum = data.resample('D', on='timestamp').sum()
+    def calculate_kwh(self, csv_file, min_val, max_val):
+        # specify column names in names parameter, a header line (if the
+        # file has one) is read as data and discarded by the conversions
+        data = pd.read_csv(csv_file, header=None,
+                           names=['timestamp', 'entry'], engine='c')
+
+        # convert 'timestamp' column to datetime in one vectorised pass,
+        # with or without fractional seconds, invalid dates (like the
+        # header row) become NaT
+        data['timestamp'] = pd.to_datetime(
+            data['timestamp'], format='ISO8601', errors='coerce')
+
+        # Convert 'entry' to float32, force non-numeric values to NaN
+        entry = pd.to_numeric(
+            data['entry'], errors='coerce', downcast='float')
+
+        # zero out readings outside the range instead of dropping rows
+        in_range = entry.between(min_val, max_val)
+        entry = entry.where(in_range, 0.0)
+
+        # calculate sum of 'entry' for each day in a single groupby, rows
+        # with invalid dates have a NaT day and are left out
+        day = data['timestamp'].dt.floor('D')
+        daily_sum = entry.groupby(day, sort=True).sum()
+
+        # like the old filter + resample, only cover the first to the last
+        # day with an in-range reading, with zeros for the days between
+        in_range_days = day[in_range].dropna()
+        if in_range_days.empty:
+            daily_sum = daily_sum.iloc[:0]
+        else:
+            daily_sum = daily_sum.loc[
+                in_range_days.min():in_range_days.max()]
+        daily_sum = daily_sum.asfreq('D', fill_value=0.0)
 
         # convert daily sum to kwh
-        daily_kwh = daily_sum['entry'] * 0.001 * (1/60)
+        daily_kwh = daily_sum * _KWH_PER_WATT_MINUTE
 
-        print(daily_kwh)
+        return daily_kwh
 
 
 def calculate_solar_output(panel_count, panel_width, panel_height, panel_wattage, panel_efficiency, daily_kwh):
+    """Scale daily kWh per square meter to the output of the panel array
+
+    daily_kwh may be a single value or the per-day Series returned by
+    Quantum.calculate_kwh."""
+
     # Calculate panel area in square meters
     panel_area = (panel_width / 1000) * (panel_height / 1000) * panel_count
 
+    # fold every panel constant into one factor so a Series is only
+    # multiplied once
+    panel_factor = panel_area * panel_efficiency * panel_wattage
+
     # Calculate the total kWh produced by the solar panels for each day
-    total_kwh = daily_kwh * panel_area * panel_efficiency * panel_wattage
-    print(total_kwh)
+    total_kwh = daily_kwh * panel_factor
+    return total_kwh
 
 
 if __name__ == "__main__":
@@ -282,6 +512,13 @@ if __name__ == "__main__":
                  'PANEL_WATTAGE', 'PANEL_EFFICIENCY', 'DAILY_KWH'),
         help='Calculate the total kWh produced by the solar panels for each day using the daily kWh values'
     )
+    parser.add_argument(
+        '--calculate_solar_output_from_csv',
+        nargs=6,
+        metavar=('CSV_FILE', 'PANEL_COUNT', 'PANEL_WIDTH', 'PANEL_HEIGHT',
+                 'PANEL_WATTAGE', 'PANEL_EFFICIENCY'),
+        help='Calculate the total kWh produced by the solar panels for each day straight from a logged entries CSV file'
+    )
 
     args = parser.parse_args()
 
@@ -312,7 +549,7 @@ if __name__ == "__main__":
 
     if args.calculate_solar_output:
         panel_count, panel_width, panel_height, panel_wattage, panel_efficiency, daily_kwh = args.calculate_solar_output
-        calculate_solar_output(
+        total_kwh = calculate_solar_output(
             int(panel_count),
             int(panel_width),
             int(panel_height),
@@ -320,3 +557,17 @@ if __name__ == "__main__":
             float(panel_efficiency),
             float(daily_kwh)
         )
+        print(total_kwh)
+
+    if args.calculate_solar_output_from_csv:
+        csv_file, panel_count, panel_width, panel_height, panel_wattage, panel_efficiency = args.calculate_solar_output_from_csv
+        kwh_per_day = q.calculate_kwh(csv_file, args.min_val, args.max_val)
+        total_kwh = calculate_solar_output(
+            int(panel_count),
+            int(panel_width),
+            int(panel_height),
+            int(panel_wattage),
+            float(panel_efficiency),
+            kwh_per_day
+        )
+        print(total_kwh)